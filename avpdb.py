@@ -9,23 +9,29 @@ A Discord bot for the AVPSO guild. Tracks quotes and show schedule, as well as s
 
 import os
 import os.path
+import io
 import sqlite3
+import hashlib
 import datetime
 import sys
 import subprocess
 import re
 import json
-import urllib
 import random
 import configparser
 import pickle
+import struct
 import itertools
 import threading
 import asyncio
 import calendar
+import time
+import functools
+import contextlib
 import rrulemap
 import durationparse
 from copy import deepcopy
+from pathlib import Path
 from typing import Optional, Union, Callable, Any
 from collections.abc import Iterable
 
@@ -38,13 +44,60 @@ _cfg.read(_config_filename)
 _params = _cfg["AVPDB"]
 _cfg_lock = threading.RLock()
 
-subprocess.check_call([sys.executable, '-m', 'pip', 'install', '-r', 'requirements.txt', '--upgrade'])
+_pip_check_filename = '.last_pip_check'
+# Always install the requirements once, so that a deployment which pulls in new dependencies still gets them with automatic upgrades turned off.
+if not os.path.exists(_pip_check_filename) or (_params.getboolean('AutoUpgrade', fallback=False) and time.time() - os.path.getmtime(_pip_check_filename) > 86400):
+	subprocess.check_call([sys.executable, '-m', 'pip', 'install', '-r', 'requirements.txt', '--upgrade'])
+	Path(_pip_check_filename).touch()
 #subprocess.check_call([sys.executable, '-m', 'pip', 'install', '--upgrade', 'discord.py', 'xdice', 'python-dateutil'])
 
 import dateutil.parser, dateutil.rrule, dateutil.tz
 import discord
 from discord.ext import commands, tasks
 from xdice import roll
+import aiosqlite
+import aiohttp
+try:
+	# uvloop is a drop-in, much faster event loop; it isn't available on Windows, so fall back to the stock loop there.
+	import uvloop
+	uvloop.install()
+except ImportError:
+	pass
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+_schedule_filename = 'schedule.json'
+_uptime_filename = 'uptime.bin'
+
+def _load_legacy(legacy_key: str) -> Any:
+	"""
+	Loads a value from the hex-encoded pickle which older versions kept in the configuration.
+	
+	Parameters:
+	
+	- `legacy_key`: The configuration key of the hex-encoded copy.
+	"""
+	return pickle.loads(bytes.fromhex(_params.get(legacy_key)))
+
+def _load_uptime() -> datetime.timedelta:
+	"""
+	Loads the total uptime, stored as a little-endian double of seconds. Falls back on the copy which older versions kept in the configuration.
+	"""
+	if os.path.exists(_uptime_filename):
+		with open(_uptime_filename, 'rb') as f:
+			return datetime.timedelta(seconds = struct.unpack('<d', f.read())[0])
+	return _load_legacy('TotalUptime')
+
+def _load_schedule() -> rrulemap.RRuleMap:
+	"""
+	Loads the schedule from its JSON snapshot. Falls back on the copy which older versions kept in the configuration.
+	"""
+	if os.path.exists(_schedule_filename):
+		with open(_schedule_filename) as f:
+			return rrulemap.RRuleMap.from_json(f.read())
+	return _load_legacy('Schedule')
 
 _token = _params.get("DiscordToken")
 _guildname = _params.get("Guild").lower()
@@ -65,33 +118,147 @@ _backup_random_dog_url = "https://dog.ceo/api/breeds/image/random"
 _random_cat_url = "https://api.thecatapi.com/v1/images/search"
 _botsource_url = 'https://github.com/Yiab0/AVPDB'
 _last_connect = datetime.datetime.now(dateutil.tz.UTC)
-_total_uptime = pickle.loads(bytes.fromhex(_params.get('TotalUptime')))
+_total_uptime = _load_uptime()
 _goosecifix_url = _params.get("GoosecifixURL")
 _showtypes = json.loads(_params['ShowTypes'])
 _reaction_patterns = { "Blobbyrape": None, "HONK": None, "Kay": None, "lee": None, "God": None, "spicybeef": None, 'Hesquatch': None, 'Goveganmotherfuckers': None, 'Tim_Noah': None, 'Oogene': None, 'interviewplant': None, 'Bombadil': None }
 _fruit_emoji = [ '\N{Green Apple}', '\N{Red Apple}', '\N{Pear}', '\N{Tangerine}', '\N{Lemon}', '\N{Banana}', '\N{Watermelon}', '\N{Grapes}', '\N{Blueberries}', '\N{Strawberry}', '\N{Melon}', '\N{Cherries}', '\N{Peach}', '\N{Mango}', '\N{Pineapple}', '\N{Kiwifruit}', '\N{Tomato}', '\N{Coconut}', '\N{Chicken}', '\N{Avocado}', '\N{Olive}' ]
 _autosave_timer = int(_params.get("AutosaveConfigTimer"))
+_save_delay = 0.5
+_config_dirty = False
+_schedule_dirty = not os.path.exists(_schedule_filename) # Older versions kept the schedule in the configuration, which the next save drops, so it has to be written out to its own file first.
+_pending_save = None
 _active_links = '\n'.join(map(lambda x: f'{x[0]}: {x[1]}', json.loads(_params['active links'])))
 _inactive_links = '\n'.join(map(lambda x: f'{x[0]}: {x[1]}', json.loads(_params['inactive links'])))
-_schedule = pickle.loads(bytes.fromhex(_params.get('Schedule')))
+_schedule = _load_schedule()
 _album_folder = 'albumcovers'
 _rpg_status = json.loads(_params.get('RPGStatus','{}'))
+_max_quote_rowid = None
+_http_session = None
+_http_timeout = aiohttp.ClientTimeout(total=5)
+_download_timeout = aiohttp.ClientTimeout(total=60)
+_max_downloads = 8
+_numpy_rangeify_min = 256 # Below this many numbers, converting to an array costs more than numpy saves.
+_name_to_member = {}
+_alias_to_name = {}
+_user_timezones = {}
+_mention_match = re.compile(r"<@!?(\d+)>").fullmatch
+_iso_date_match = re.compile(r"\d{4}-\d{2}-\d{2}").match
+# Every trigger sits in its own lookahead so that one scan of a message finds them all, even where they overlap.
+_find_triggers = re.compile('|'.join(f'(?=(?P<{k}>{v}))' for k, v in (
+	('blobby', 'b[l1][o0]bby'),
+	('honk', 'g[o0e3]{2}s[e3]'),
+	('brandon', 'br[a4]nd[o0]n'),
+	('cook', 'c[o0]{2}k'),
+	('eat', '(?:\\W|^)[e3][a4]t'),
+	('chicken', 'chicken'),
+	('beef', 'beef'),
+	('pain0', 'pain~[01](?:\\D|$)'),
+	('pain2', 'pain~[23](?:\\D|$)'),
+	('pain4', 'pain~[45](?:\\D|$)'),
+	('pain6', 'pain~[67](?:\\D|$)'),
+	('pain8', 'pain~[89](?:\\D|$)'),
+	('pain10', 'pain~10(?:\\D|$)'),
+	('interview', 'interview'),
+	('bombadil', 'том бомбадилло'),
+))).finditer
+_speech = "\N{Left Speech Bubble}" # '\U0001f5e8'; reacting to a message with this quotes it.
 
 _intents = discord.Intents.default()
 _intents.members = True
 bot = commands.Bot(command_prefix=_cpx, description=f"A Discord bot for AVPSO. Type {_cpx}help for a list of commands.", intents=_intents, case_insensitive=True)
 
-def _save_config() -> None:
+def _write_atomic(filename: str, data: Union[str, bytes]) -> None:
 	"""
-	Save the current configuration to the default file.
+	Replaces the contents of a file in a single step, so that an interrupted write can't leave it truncated.
+	
+	Parameters:
+	
+	- `filename`: The file to write.
+	- `data`: The new contents of the file.
+	"""
+	with open(f'{filename}.tmp', 'wb' if isinstance(data, bytes) else 'w') as f:
+		f.write(data)
+	os.replace(f'{filename}.tmp', filename)
+
+def _write_saved(filename: str, data: Union[str, bytes]) -> None:
+	"""
+	Writes out one of the saved files, one save at a time. Safe to call from a worker thread, as long as `data` was produced on the event loop.
+	
+	Parameters:
+	
+	- `filename`: The file to write.
+	- `data`: The new contents of the file.
 	"""
 	with _cfg_lock:
-		_params['TotalUptime'] = pickle.dumps(_total_uptime + (datetime.datetime.now(dateutil.tz.UTC) - _last_connect)).hex()
-		_params['RPGStatus'] = json.dumps(_rpg_status)
-		with open(_config_filename, "w") as configfile:
-			_cfg.write(configfile)
-			print(f"{_dt_tostr()} Saved configuration.")
+		_write_atomic(filename, data)
+
+async def _save_schedule() -> None:
+	"""
+	Save the schedule to its own file. Only needs to be called when the schedule changes.
+	"""
+	# Serialize here on the event loop, so the worker thread never sees the schedule half-way through a change.
+	data = _schedule.to_json()
+	await asyncio.to_thread(_write_saved, _schedule_filename, data)
+
+async def _save_uptime() -> None:
+	"""
+	Save the total uptime to its own file.
+	"""
+	data = struct.pack('<d', (_total_uptime + (datetime.datetime.now(dateutil.tz.UTC) - _last_connect)).total_seconds())
+	await asyncio.to_thread(_write_saved, _uptime_filename, data)
+
+async def _save_config() -> None:
+	"""
+	Save the current configuration to the default file.
+	"""
+	for k in ('TotalUptime', 'Schedule'):
+		_cfg.remove_option(_params.name, k)
+		_cfg.remove_option(configparser.DEFAULTSECT, k)
+	_params['RPGStatus'] = json.dumps(_rpg_status)
+	_params['ShowTypes'] = json.dumps(_showtypes)
+	buf = io.StringIO()
+	_cfg.write(buf)
+	await asyncio.to_thread(_write_saved, _config_filename, buf.getvalue())
+	print(f"{_dt_tostr()} Saved configuration.")
+
+async def _flush_config() -> None:
+	"""
+	Writes out the configuration and the schedule if they have changed since they were last saved.
+	"""
+	global _config_dirty, _schedule_dirty
+	if _schedule_dirty:
+		_schedule_dirty = False
+		await _save_schedule()
+	if _config_dirty:
+		_config_dirty = False
+		await _save_config()
+
+async def _debounced_save() -> None:
+	"""
+	Waits for a burst of changes to settle, then saves them all at once. Keeps going until nothing is left unsaved, so changes made while a save is being written aren't dropped.
+	"""
+	while _config_dirty or _schedule_dirty:
+		await asyncio.sleep(_save_delay)
+		await _flush_config()
+
+def _mark_dirty(schedule: bool = False) -> None:
+	"""
+	Records that the configuration (or the schedule) has changed, and arranges for it to be saved shortly. Changes made before that save happens are written together.
+	
+	Parameters:
+	
+	- `schedule` (default: False): Whether it was the schedule that changed, rather than the configuration.
+	"""
+	global _config_dirty, _schedule_dirty, _pending_save
+	if schedule:
+		_schedule_dirty = True
+	else:
+		_config_dirty = True
+	if _pending_save == None or _pending_save.done():
+		_pending_save = asyncio.create_task(_debounced_save())
 
+@functools.lru_cache(maxsize=256)
 def _tz_fromstr(n: str) -> Union[dateutil.tz.tzutc, dateutil.tz.tzfile, None]:
 	"""
 	Translates the given `str` into a time zone.
@@ -116,8 +283,71 @@ def _dt_tostr(dt: Optional[datetime.datetime] = None) -> str:
 		dt = datetime.datetime.now(dateutil.tz.UTC)
 	return dt.strftime(_timestamp_zoned).format(tz = rrulemap._tz_tostr(dt.tzinfo))
 
-db = sqlite3.connect("quotes.db")
-cursor = db.cursor()
+def _quote_hash(user: Union[discord.Member, discord.User, str], message: str) -> int:
+	"""
+	Computes a stable 64-bit hash identifying a quote by its author and content.
+	
+	Parameters:
+	
+	- `user`: The author of the quote.
+	- `message`: The quote.
+	"""
+	return int.from_bytes(hashlib.blake2b(str(user).encode() + b'\x1f' + message.encode(), digest_size=8).digest(), 'little', signed=True)
+
+async def _rehash_quotes() -> None:
+	"""
+	Fills in the hash of every quote whose hash has been cleared. A quote which duplicates an earlier quote by the same user keeps a `NULL` hash.
+	"""
+	rows = await db.execute_fetchall("SELECT ROWID, user, message FROM quotes WHERE hash IS NULL")
+	await db.executemany("UPDATE OR IGNORE quotes SET hash=? WHERE ROWID=?", [ (_quote_hash(u, m), r) for r, u, m in rows ])
+
+async def _fetchone(sql: str, params: Iterable[Any] = ()) -> Optional[tuple]:
+	"""
+	Runs a query against the quote database and returns the first resulting row, or `None` if there are no results.
+	
+	Parameters:
+	
+	- `sql`: The query.
+	- `params` (default: ()): The parameters for the query.
+	"""
+	async with db.execute(sql, params) as c:
+		return await c.fetchone()
+
+_db_filename = "quotes.db"
+_db_pragmas = "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA temp_store=MEMORY; PRAGMA mmap_size=268435456; PRAGMA cache_size=-20000; PRAGMA wal_autocheckpoint=1000;"
+db = None # Opened in `setup_hook`, once there is an event loop to run it on.
+_db_lock = asyncio.Lock()
+
+@contextlib.asynccontextmanager
+async def _transaction():
+	"""
+	Runs the statements in the body as a single transaction on the quote database, committing them if the body finishes and rolling them back if it raises. Every write holds `_db_lock`, so no other command's statements can end up inside the transaction.
+	"""
+	async with _db_lock:
+		await db.execute('BEGIN')
+		try:
+			yield
+		except BaseException:
+			await db.execute('ROLLBACK')
+			raise
+		await db.execute('COMMIT')
+
+async def _write(sql: str, params: Iterable[Any] = ()) -> int:
+	"""
+	Runs a single statement which changes the quote database, waiting for any transaction in progress to finish first. Returns the number of rows changed.
+	
+	Parameters:
+	
+	- `sql`: The statement.
+	- `params` (default: ()): The parameters for the statement.
+	"""
+	async with _db_lock:
+		return (await db.execute(sql, params)).rowcount
+
+_setup_db = sqlite3.connect(_db_filename, isolation_level=None)
+cursor = _setup_db.cursor()
+cursor.executescript(_db_pragmas)
+cursor.execute('BEGIN')
 cursor.execute("CREATE TABLE IF NOT EXISTS quotes(hash INTEGER,user TEXT,message TEXT,date_added TEXT)")
 cursor.execute("CREATE TABLE IF NOT EXISTS aliases(alias TEXT PRIMARY KEY,user TEXT)")
 cursor.execute("CREATE TABLE IF NOT EXISTS honcs(latin TEXT, english TEXT, author TEXT)")
@@ -127,10 +357,34 @@ cursor.execute("CREATE TABLE IF NOT EXISTS perversions(name TEXT UNIQUE, descrip
 cursor.execute('CREATE TABLE IF NOT EXISTS users(name TEXT PRIMARY KEY, timezone TEXT)')
 cursor.execute('CREATE TABLE IF NOT EXISTS albums(tweetid INTEGER PRIMARY KEY, band TEXT, album TEXT)')
 cursor.execute('CREATE TABLE IF NOT EXISTS rapescenes(datetime TEXT)')
+# The trigram tokenizer lets FTS5 answer arbitrary substring searches, so `quotesearch` keeps the semantics it had with LIKE.
+cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS quotes_fts USING fts5(message, content='quotes', tokenize='trigram')")
+cursor.execute("CREATE TRIGGER IF NOT EXISTS quotes_fts_insert AFTER INSERT ON quotes BEGIN INSERT INTO quotes_fts(rowid, message) VALUES(new.ROWID, new.message); END")
+cursor.execute("CREATE TRIGGER IF NOT EXISTS quotes_fts_delete AFTER DELETE ON quotes BEGIN INSERT INTO quotes_fts(quotes_fts, rowid, message) VALUES('delete', old.ROWID, old.message); END")
+cursor.execute("CREATE TRIGGER IF NOT EXISTS quotes_fts_update AFTER UPDATE OF message ON quotes BEGIN INSERT INTO quotes_fts(quotes_fts, rowid, message) VALUES('delete', old.ROWID, old.message); INSERT INTO quotes_fts(rowid, message) VALUES(new.ROWID, new.message); END")
+_db_version = cursor.execute('PRAGMA user_version').fetchone()[0]
+if _db_version < 1:
+	# Older quote hashes came from the salted builtin `hash`, so they differ from process to process.
+	cursor.execute('UPDATE quotes SET hash=NULL')
+if _db_version < 2:
+	# Rape scenes used to be logged as "[%Y-%m-%d %H:%M:%S]"; drop the brackets so they are plain ISO8601.
+	cursor.execute("UPDATE rapescenes SET datetime=substr(datetime, 2, 19) WHERE datetime LIKE '[%'")
+if _db_version < 3:
+	cursor.execute("INSERT INTO quotes_fts(quotes_fts) VALUES('rebuild')")
+cursor.execute('PRAGMA user_version=3')
+cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS quotes_hash_uniq ON quotes(hash)")
+cursor.execute("CREATE INDEX IF NOT EXISTS quotes_user_idx ON quotes(user)")
+cursor.execute("CREATE INDEX IF NOT EXISTS perversions_name_nocase ON perversions(name COLLATE NOCASE)")
+try:
+	cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS smells_name_nocase ON smells(name COLLATE NOCASE)")
+except sqlite3.IntegrityError:
+	print(f"{_dt_tostr()} Some smells differ only by case; they will stay distinct until the duplicates are removed.")
+cursor.executemany("UPDATE OR IGNORE quotes SET hash=? WHERE ROWID=?", [ (_quote_hash(u, m), r) for r, u, m in cursor.execute("SELECT ROWID, user, message FROM quotes WHERE hash IS NULL").fetchall() ])
+cursor.execute('COMMIT')
+_setup_db.close()
+del _setup_db, cursor
 print(f"{_dt_tostr()} Loaded quote database.")
 
-db.commit()
-
 os.makedirs(_album_folder, exist_ok = True)
 
 def _is_guild_owner() -> Callable[[discord.ext.commands.Context], bool]:
@@ -165,7 +419,7 @@ def format_quote(quote: tuple[int, str, str, str]) -> discord.Embed:
 		embed.set_author(name=user.display_name)
 	return embed
 
-def insert_quote(user: Union[discord.Member, discord.User], message: str) -> tuple[bool, int]:
+async def insert_quote(user: Union[discord.Member, discord.User], message: str) -> tuple[bool, int]:
 	"""
 	Tries to insert a quote into the database. If the quote already exists from the same user, returns `False` and the quote number. If the quote doesn't already exist from the same user, inserts the quote and returns `True` and the quote number.
 	
@@ -174,14 +428,63 @@ def insert_quote(user: Union[discord.Member, discord.User], message: str) -> tup
 	- `user`: The author of the quote.
 	- `message`: The quote.
 	"""
-	h = hash(str(user) + message)
-	cursor.execute("SELECT ROWID, user, message FROM quotes WHERE hash=?", (str(h),))
-	for q in cursor.fetchall():
-		if q[1] == str(user) and q[2] == message:
-			return (False, q[0])
-	cursor.execute("INSERT INTO quotes VALUES(?,?,?,?)", (str(h), str(user), message, _dt_tostr()))
-	db.commit()
-	return (True, cursor.lastrowid)
+	global _max_quote_rowid
+	h = _quote_hash(user, message)
+	async with _db_lock:
+		q = await db.execute_fetchall("INSERT INTO quotes VALUES(?,?,?,?) ON CONFLICT(hash) DO NOTHING RETURNING ROWID", (h, str(user), message, _dt_tostr()))
+	if len(q) == 0:
+		return (False, (await _fetchone("SELECT ROWID FROM quotes WHERE hash=?", (h,)))[0])
+	_max_quote_rowid = None
+	return (True, q[0][0])
+
+async def _random_quote() -> Optional[tuple[int, str, str, str]]:
+	"""
+	Picks a random quote without sorting the whole table. Returns `None` if the database has no quotes.
+	"""
+	global _max_quote_rowid
+	if _max_quote_rowid == None:
+		_max_quote_rowid = (await _fetchone("SELECT MAX(ROWID) FROM quotes"))[0]
+		if _max_quote_rowid == None:
+			return None
+	q = await _fetchone("SELECT ROWID, user, message, date_added FROM quotes WHERE ROWID>=? ORDER BY ROWID LIMIT 1", (random.randint(1, _max_quote_rowid),))
+	if q == None:
+		# The cached maximum is stale, so look it up again.
+		_max_quote_rowid = None
+		return await _random_quote()
+	return q
+
+async def _random_rows(table: str, columns: str, where: str = '', params: tuple = (), k: int = 1) -> list[tuple]:
+	"""
+	Picks up to `k` distinct random rows from a table without sorting the whole table.
+	
+	Parameters:
+	
+	- `table`: The table to pick from.
+	- `columns`: The columns to retrieve, as they would be written in a `SELECT` statement.
+	- `where` (default: ''): A `WHERE` clause restricting which rows may be picked.
+	- `params` (default: ()): The parameters for `where`.
+	- `k` (default: 1): How many rows to pick.
+	"""
+	# Holding the write lock keeps the count valid until every offset has been fetched.
+	async with _db_lock:
+		n = (await _fetchone(f"SELECT COUNT(*) FROM {table} {where}", params))[0]
+		return [ await _fetchone(f"SELECT {columns} FROM {table} {where} ORDER BY ROWID LIMIT 1 OFFSET ?", (*params, i)) for i in random.sample(range(n), min(k, n)) ]
+
+def _quote_search(terms: list[str]) -> tuple[str, list[str]]:
+	"""
+	Builds a `WHERE` condition (and its parameters) matching the quotes which contain every one of `terms`, ignoring case. Terms of at least three characters are looked up in the full-text index; shorter ones can't be, so they fall back on `LIKE`. Either way `%` and `_` are matched literally rather than as wildcards, though `LIKE` only ignores the case of ASCII letters.
+	
+	Parameters:
+	
+	- `terms`: The lowercase search terms.
+	"""
+	indexed = [ t for t in terms if len(t) >= 3 ]
+	conditions = [ "LOWER(message) LIKE ? ESCAPE '\\'" for t in terms if len(t) < 3 ]
+	params = [ '%' + t.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%' for t in terms if len(t) < 3 ]
+	if len(indexed) > 0:
+		conditions.insert(0, "ROWID IN (SELECT rowid FROM quotes_fts WHERE quotes_fts MATCH ?)")
+		params.insert(0, ' AND '.join([ '"' + t.replace('"', '""') + '"' for t in indexed ]))
+	return ' AND '.join(conditions), params
 
 def get_id_from_string(x: str) -> Optional[int]:
 	"""
@@ -191,9 +494,9 @@ def get_id_from_string(x: str) -> Optional[int]:
 	
 	- `x`: A string that might represent a user id.
 	"""
-	if not isinstance(x,str):
+	if not isinstance(x,str) or x[:1] != '<':
 		return None
-	r = re.fullmatch("<@!?(\\d+)>", x)
+	r = _mention_match(x)
 	if r:
 		return int(r.group(1))
 	return None
@@ -208,6 +511,32 @@ def mention_or_str(user: Any) -> str:
 	"""
 	return getattr(user, 'mention', str(user))
 
+def _index_members() -> None:
+	"""
+	Rebuilds the index of the main guild's members by name which `find_user` consults. Full usernames take precedence over nicknames and bare names, mirroring `discord.Guild.get_member_named`.
+	"""
+	global _name_to_member
+	index = { str(m): m for m in _main_guild.members }
+	for m in _main_guild.members:
+		for n in (m.nick, getattr(m, 'global_name', None), m.name):
+			if n:
+				index.setdefault(n, m)
+	_name_to_member = index
+
+async def _load_aliases() -> None:
+	"""
+	Reloads the alias table which `find_user` consults from the database.
+	"""
+	global _alias_to_name
+	_alias_to_name = dict(await db.execute_fetchall("SELECT alias, user FROM aliases"))
+
+async def _load_user_timezones() -> None:
+	"""
+	Reloads the stored time zones which `_get_user_timezone` consults from the database.
+	"""
+	global _user_timezones
+	_user_timezones = { n: _tz_fromstr(tz) for n, tz in await db.execute_fetchall("SELECT name, timezone FROM users") }
+
 def find_user(name: str) -> Optional[discord.Member]:
 	"""
 	Transforms a string into the user that string represents. Takes into account the bot's alias database and can retrieve users from the guild's names as well as the user id. Returns `None` if no such user can be found.
@@ -216,20 +545,23 @@ def find_user(name: str) -> Optional[discord.Member]:
 	
 	- `name`: The name of the user to be found.
 	"""
-	user = _main_guild.get_member_named(name)
-	if user != None:
-		return user
 	q = get_id_from_string(name)
 	if q != None:
-		user = _main_guild.get_member(q)
-		if user != None:
-			return user
-	q = cursor.execute("SELECT user FROM aliases WHERE alias=? LIMIT 1", (name.lower(),)).fetchone()
-	if q != None:
-		user = _main_guild.get_member_named(q[0])
-		if user != None:
-			return user
-	return None
+		return _main_guild.get_member(q)
+	user = _name_to_member.get(name)
+	if user != None:
+		return user
+	return _name_to_member.get(_alias_to_name.get(name.lower()))
+
+def find_users(names: Iterable[str]) -> list[Optional[discord.Member]]:
+	"""
+	Calls `find_user` on each of `names`.
+	
+	Parameters:
+	
+	- `names`: The names of the users to be found.
+	"""
+	return [ find_user(n) for n in names ]
 
 def to_user(name: str) -> str:
 	"""
@@ -253,6 +585,18 @@ async def in_avpso(ctx: discord.ext.commands.Context) -> bool:
 		return ctx.guild.name.lower() == _guildname
 	return True
 
+@bot.event
+async def setup_hook() -> None:
+	"""
+	Opens the quote database and the HTTP session. Runs once, on the event loop but before connecting to Discord, so they are ready before any command or event can use them.
+	"""
+	global db, _http_session
+	db = await aiosqlite.connect(_db_filename, isolation_level=None)
+	await db.executescript(_db_pragmas)
+	await _load_aliases()
+	await _load_user_timezones()
+	_http_session = aiohttp.ClientSession(timeout=_http_timeout)
+
 @bot.event
 async def on_ready() -> None:
 	"""
@@ -270,86 +614,105 @@ async def on_ready() -> None:
 			if r.name.lower() == 'the pantheon':
 				_pantheon = r
 				break
+		_index_members()
+	wanted = frozenset(_reaction_patterns)
 	for e in bot.emojis:
-		if e.name in _reaction_patterns:
+		if e.name in wanted:
 			_reaction_patterns[e.name] = e
 
+@bot.listen('on_member_join')
+@bot.listen('on_member_remove')
+async def reindex_members(member):
+	if member.guild == _main_guild:
+		_index_members()
+
+@bot.listen('on_member_update')
+@bot.listen('on_user_update')
+async def reindex_renamed_member(before, after):
+	if _main_guild != None and (str(before), getattr(before, 'nick', None), getattr(before, 'global_name', None)) != (str(after), getattr(after, 'nick', None), getattr(after, 'global_name', None)):
+		_index_members()
+
 @bot.command(aliases = [ 'log_rape' ], help = 'Logs that a rape scene was seen.')
 async def logrape(ctx):
-	global _timestamp_unzoned
-	cursor.execute('INSERT INTO rapescenes VALUES(?)',(datetime.datetime.utcnow().strftime(_timestamp_unzoned),))
+	await _write('INSERT INTO rapescenes VALUES(?)',(datetime.datetime.utcnow().isoformat(' ', 'seconds'),))
 	await ctx.reply('Logged.')
-	db.commit()
 
 @bot.command(aliases = [ 'rape_check', 'check_rape', 'checkrape' ], help = 'How long since the last rape scene?')
 async def rapecheck(ctx):
-	global _timestamp_unzoned
-	q = cursor.execute('SELECT datetime FROM rapescenes ORDER BY datetime DESC LIMIT 1').fetchone()[0]
-	p = datetime.datetime.strptime(q, _timestamp_unzoned)
-	c = datetime.datetime.utcnow()
-	await ctx.reply(f'It has been {(c-p).days} days since the last rape scene on AVPSO.')
+	q = (await _fetchone('SELECT MAX(datetime) FROM rapescenes'))[0]
+	if q == None:
+		await ctx.reply('No rape scenes have been logged yet.')
+		return
+	await ctx.reply(f'It has been {(datetime.datetime.utcnow()-datetime.datetime.fromisoformat(q)).days} days since the last rape scene on AVPSO.')
 
 @bot.command(aliases = [ 'rapeless_record' ], help = 'The longest amount of time we have gone between rape scenes so far.')
 async def rapelessrecord(ctx):
-	global _timestamp_unzoned
-	q = cursor.execute('SELECT datetime FROM rapescenes ORDER BY datetime').fetchall()
-	p = list(map(lambda x: datetime.datetime.strptime(x[0], _timestamp_unzoned), q))
-	d = 0
-	for i in range(len(p)-1):
-		d = max(d, (p[i+1]-p[i]).days)
-	await ctx.reply(f'The longest time between rape scenes so far is {max(d, (datetime.datetime.utcnow()-p[-1]).days)} days.')
+	d = (await _fetchone("SELECT CAST(MAX(gap) AS INTEGER) FROM (SELECT julianday(datetime) - julianday(LAG(datetime) OVER (ORDER BY datetime)) AS gap FROM rapescenes UNION ALL SELECT julianday('now') - julianday(MAX(datetime)) FROM rapescenes)"))[0]
+	if d == None:
+		await ctx.reply('No rape scenes have been logged yet.')
+		return
+	await ctx.reply(f'The longest time between rape scenes so far is {d} days.')
 
 @bot.command(aliases=['add_alias'], brief="Adds an alias for a user.", help="Adds an alias for a user. The alias must be alphamuneric and begin with a letter. Aliases are not case sensitive.")
 async def addalias(ctx, alias, username):
 	if len(alias) == 0 or (not alias.isalnum()) or (not alias[0].isalpha()):
 		await ctx.reply("You can only associate aliases which are alphanumeric and begin with a letter.")
 		return
-	q = cursor.execute("SELECT * FROM aliases WHERE alias=? LIMIT 1", (alias.lower(),)).fetchone()
+	q = _alias_to_name.get(alias.lower())
 	if q != None:
-		await ctx.reply(f"{q[0]} is already an alias for {q[1]}.")
+		await ctx.reply(f"{alias.lower()} is already an alias for {q}.")
 		return
 	user = find_user(username)
 	if user == None:
 		await ctx.reply(f"Cannot find a user named {username}.")
 		return
-	cursor.execute("INSERT INTO aliases VALUES(?,?)", (alias.lower(), str(user)))
-	cursor.execute("UPDATE quotes SET user=? WHERE LOWER(user)=?", (str(user), alias.lower()))
+	try:
+		async with _transaction():
+			await db.execute("INSERT INTO aliases VALUES(?,?)", (alias.lower(), str(user)))
+			n = (await db.execute("UPDATE quotes SET user=?, hash=NULL WHERE LOWER(user)=?", (str(user), alias.lower()))).rowcount
+			await _rehash_quotes()
+	except sqlite3.IntegrityError:
+		await ctx.reply(f"{alias.lower()} is already an alias for {_alias_to_name.get(alias.lower())}.")
+		return
+	_alias_to_name[alias.lower()] = str(user)
 	await ctx.reply(f"Successfully added {alias} as an alias for {mention_or_str(user)}.")
-	if cursor.rowcount > 0:
-		await ctx.reply(f"Reattributed {str(cursor.rowcount)} old quote{'' if cursor.rowcount == 1 else 's'} to {mention_or_str(user)}.")
-	db.commit()
+	if n > 0:
+		await ctx.reply(f"Reattributed {str(n)} old quote{'' if n == 1 else 's'} to {mention_or_str(user)}.")
 
 @bot.command(aliases=['get_alias'], brief="What aliases a user has.", help="Retrieves aliases associated with the given username or alias.")
 async def getalias(ctx, name):
 	user = to_user(name)
-	aliases = cursor.execute("SELECT alias FROM aliases WHERE user=?", (str(user),)).fetchall()
+	aliases = [ a for a, u in _alias_to_name.items() if u == str(user) ]
 	if len(aliases) == 0:
 		await ctx.reply(f"There are no aliases in the database for {mention_or_str(user)}.")
 		return
-	await ctx.reply(embed=discord.Embed(title=f"Aliases of {getattr(user,'display_name',str(user))}", description=", ".join([ q[0] for q in aliases ] + [ mention_or_str(user) ])))
+	await ctx.reply(embed=discord.Embed(title=f"Aliases of {getattr(user,'display_name',str(user))}", description=", ".join(aliases + [ mention_or_str(user) ])))
 
 @bot.command(aliases=['del_alias'], brief="Deletes an alias (restricted).", help="Deletes an alias from the database (only available to authorized users).")
 @commands.is_owner()
 async def delalias(ctx, name):
-	cursor.execute("DELETE FROM aliases WHERE alias=?", (name.lower(),))
-	if cursor.rowcount == 1:
+	n = await _write("DELETE FROM aliases WHERE alias=?", (name.lower(),))
+	_alias_to_name.pop(name.lower(), None)
+	if n == 1:
 		await ctx.reply(f"Deleted the alias {name.lower()}")
-	elif cursor.rowcount == 0:
+	elif n == 0:
 		await ctx.reply(f"There is no alias in the database for {name.lower()}.")
 	else:
-		await ctx.reply(f"Deleted (somehow) {str(cursor.rowcount)} aliase{'' if cursor.rowcount == 1 else 's'} for {name.lower()}.")
+		await ctx.reply(f"Deleted (somehow) {str(n)} aliase{'' if n == 1 else 's'} for {name.lower()}.")
 
 @bot.command(brief='Reattributes all quotes correctly (restricted).', help='Reattributes all quotes in the database to the appropriate usernames based on the current alias table (only available to authorized users).', hidden=True)
 @commands.is_owner()
 async def reattribute(ctx):
-	all_quoted = map(lambda x: x[0], cursor.execute('SELECT DISTINCT user FROM quotes').fetchall())
-	for n in all_quoted:
-		n3 = to_user(n)
-		nn = str(n3)
-		if n != nn:
-			q = cursor.execute('UPDATE quotes SET user=? WHERE user=?',(nn, n)).rowcount
-			if q > 0:
-				await ctx.reply(f'Reattributed {str(q)} quote{"" if q == 1 else "s"} from {n} to {mention_or_str(n3)}.')
+	await _load_aliases()
+	async with _transaction():
+		moved = [ (n, to_user(u), q) for n, u, q in await db.execute_fetchall('SELECT q.user, a.user, COUNT(*) FROM quotes q JOIN aliases a ON a.alias=LOWER(q.user) WHERE q.user!=a.user GROUP BY q.user') ]
+		await db.execute('UPDATE quotes SET user=a.user, hash=NULL FROM aliases a WHERE a.alias=LOWER(quotes.user) AND quotes.user!=a.user')
+		rows = await db.execute_fetchall('SELECT user, COUNT(*) FROM quotes GROUP BY user')
+		renamed = [ (n, u, q) for (n, q), u in zip(rows, find_users(n for n, _ in rows)) if u != None and str(u) != n ]
+		await db.executemany('UPDATE quotes SET user=?, hash=NULL WHERE user=?', [ (str(u), n) for n, u, q in renamed ])
+		await _rehash_quotes()
+	for n, u, q in moved + renamed:
+		await ctx.reply(f'Reattributed {str(q)} quote{"" if q == 1 else "s"} from {n} to {mention_or_str(u)}.')
 	await ctx.reply('Finished total attribution re-check.')
 
 @bot.command(help="Ping the bot.")
@@ -363,7 +726,7 @@ async def addquote(ctx, user, *, message):
 		await ctx.reply(f"The correct syntax is ```{_cpx}addquote *user* *message*```")
 	else:
 		author = to_user(user)
-		a,b = insert_quote(author, message)
+		a,b = await insert_quote(author, message)
 		if a:
 			await ctx.reply(f"Successfully attributed quote #{b} to {mention_or_str(author)}.")
 		else:
@@ -372,8 +735,7 @@ async def addquote(ctx, user, *, message):
 @bot.command(aliases=['get_quote'], brief="Retrieves a random or specified quote.", help="Retrieves a random quote by the target user (optional; any random quote if omitted), or the quote with the specified number.")
 async def getquote(ctx, target=None):
 	if target == None or len(target) == 0:
-		cursor.execute("SELECT ROWID, user, message, date_added FROM quotes ORDER BY RANDOM() LIMIT 1")
-		q = cursor.fetchone()
+		q = await _random_quote()
 		if q == None:
 			await ctx.reply("The database has no quotes.")
 			return
@@ -381,35 +743,35 @@ async def getquote(ctx, target=None):
 		num = target
 		if target.startswith('#'):
 			num = target[1:]
-		cursor.execute("SELECT ROWID, user, message, date_added FROM quotes WHERE ROWID=? LIMIT 1", (num,))
-		q = cursor.fetchone()
+		q = await _fetchone("SELECT ROWID, user, message, date_added FROM quotes WHERE ROWID=? LIMIT 1", (num,))
 		if q == None:
 			await ctx.reply(f"The database has no quote numbered {num}.")
 			return
 	else:
 		user = to_user(target)
-		cursor.execute("SELECT ROWID, user, message, date_added FROM quotes WHERE user=? ORDER BY RANDOM() LIMIT 1", (str(user),))
-		q = cursor.fetchone()
-		if q == None:
+		q = await _random_rows("quotes", "ROWID, user, message, date_added", "WHERE user=?", (str(user),))
+		if len(q) == 0:
 			await ctx.reply(f"The database has no quotes from {mention_or_str(user)}.")
 			return
+		q = q[0]
 	await ctx.reply(embed=format_quote(q))
 
 @bot.command(aliases=['del_quote'], brief="Delete a quote (restricted).", help="Deletes quote numbered <quote_number> from the database (only available to authorized users).")
 @commands.is_owner()
 async def delquote(ctx, quote_number):
+	global _max_quote_rowid
 	if quote_number == None or len(quote_number) == 0:
 		await ctx.reply(f"The correct syntax is ```{_cpx}delquote *number*```")
 		return
 	if quote_number.isdecimal():
-		cursor.execute("DELETE FROM quotes WHERE ROWID=?", (quote_number,))
-		if cursor.rowcount == 1:
+		n = await _write("DELETE FROM quotes WHERE ROWID=?", (quote_number,))
+		_max_quote_rowid = None
+		if n == 1:
 			await ctx.reply(f"Deleted quote #{quote_number}.")
-		elif cursor.rowcount > 1:
-			await ctx.reply(f"Deleted (somehow) {str(cursor.rowcount)} quotes numbered {quote_number}.")
+		elif n > 1:
+			await ctx.reply(f"Deleted (somehow) {str(n)} quotes numbered {quote_number}.")
 		else:
 			await ctx.reply("Can't find a quote with that number to delete.")
-		db.commit()
 
 @bot.command(aliases=["r","dice",'rolldice','roll'], brief="Roll dice.", help="Rolls the given dice and prints the result to chat. This operation passes everything following the command to the xdice package; see https://xdice.readthedocs.io/en/latest/index.html for details. This is intended to be replaced in the future.")
 async def roll_dice(ctx, *, dice_string):
@@ -422,8 +784,7 @@ async def roll_dice(ctx, *, dice_string):
 @bot.command(aliases=["getquotes",'get_quotes_by','get_quotes'], brief=f"Retrieves all quotes (max {_max_quote_display}) by the user.", help=f"Retrieves all quotes by the specified user. If there are more than {_max_quote_display} such quotes in the database, returns {_max_quote_display} random ones.")
 async def getquotesby(ctx, user):
 	author = to_user(user)
-	cursor.execute("SELECT ROWID, user, message, date_added FROM quotes WHERE user=? ORDER BY RANDOM() LIMIT ? ", (str(author), str(_max_quote_display)))
-	res = cursor.fetchall()
+	res = await _random_rows("quotes", "ROWID, user, message, date_added", "WHERE user=?", (str(author),), _max_quote_display)
 	if len(res) == 0:
 		await ctx.reply(f"There are no quotes attributed to {mention_or_str(author)}.")
 	else:
@@ -433,45 +794,59 @@ async def getquotesby(ctx, user):
 @bot.command(aliases=['num_quotes'], brief="Says how many quotes are in the database.", help="Retrieves the number of quotes and number of users in the database. If a user is specified, retrieves the number of quotes by that user.")
 async def numquotes(ctx, user=None):
 	if user == None or len(user) == 0:
-		cursor.execute("SELECT COUNT(*) FROM quotes GROUP BY user")
-		u = cursor.fetchall()
-		u = [ a[0] for a in u ]
-		await ctx.reply(f"There are {sum(u)} quotes in the database attributed to {len(u)} users.")
+		n, u = await _fetchone("SELECT COUNT(*), COUNT(DISTINCT user) FROM quotes")
+		await ctx.reply(f"There are {n} quotes in the database attributed to {u} users.")
 	else:
 		author = to_user(user)
-		cursor.execute("SELECT COUNT(*) FROM quotes WHERE user=? GROUP BY user", (str(author),))
-		u = cursor.fetchall()
-		if len(u) == 0:
+		n = (await _fetchone("SELECT COUNT(*) FROM quotes WHERE user=?", (str(author),)))[0]
+		if n == 0:
 			await ctx.reply(f"There are no quotes in the database attributed to {mention_or_str(author)}.")
-		elif u[0][0] == 1:
+		elif n == 1:
 			await ctx.reply(f"There is 1 quote in the database attributed to {mention_or_str(author)}.")
 		else:
-			await ctx.reply(f"There are {u[0][0]} quotes in the database attributed to {mention_or_str(author)}.")
+			await ctx.reply(f"There are {n} quotes in the database attributed to {mention_or_str(author)}.")
 
 @bot.command(aliases=['log_off'], hidden=True, brief="Logs the bot off (restricted).", help="Logs the bot off (only available to authorized users).")
 @commands.check_any(commands.is_owner(), _is_guild_owner())
 async def logoff(ctx):
 	print(f"{_dt_tostr()} Quitting as instructed by {str(ctx.author)}.")
-	db.close()
-	_save_config()
+	await db.close()
+	await _http_session.close()
+	await _flush_config()
+	await _save_uptime()
 	await bot.close()
 
+async def _fetch_json(url: str) -> Any:
+	"""
+	Retrieves and decodes a JSON document over the shared HTTP session. Returns `None` if the document can't be retrieved or the server answers with an error status.
+	
+	Parameters:
+	
+	- `url`: Where to find the document.
+	"""
+	try:
+		async with _http_session.get(url) as r:
+			r.raise_for_status()
+			return await r.json(content_type=None)
+	except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+		return None
+
 @bot.command(brief="Display a random dog photo.", help="Find a random photo of a dog through https://thedogapi.com/ or https://dog.ceo/dog-api and display it in chat.")
 async def dog(ctx):
-	resp = json.loads(urllib.request.urlopen(_random_dog_url).read())
-	if len(resp) > 0:
+	resp = await _fetch_json(_random_dog_url)
+	if resp:
 		await ctx.reply(resp[0]["url"])
+		return
+	backup = await _fetch_json(_backup_random_dog_url)
+	if backup and "message" in backup:
+		await ctx.reply(backup["message"])
 	else:
-		resp = json.loads(urllib.request.urlopen(_backup_random_dog_url).read())
-		if "message" in resp:
-			await ctx.reply(resp["message"])
-		else:
-			await ctx.reply("Dog APIs are unreachable at the moment.")
+		await ctx.reply("Dog APIs are unreachable at the moment.")
 
 @bot.command(brief="Display a random cat photo.", help="Find a random photo of a cat through https://thecatapi.com/ and display it in chat.")
 async def cat(ctx):
-	resp = json.loads(urllib.request.urlopen(_random_cat_url).read())
-	if len(resp) > 0:
+	resp = await _fetch_json(_random_cat_url)
+	if resp:
 		await ctx.reply(resp[0]["url"])
 	else:
 		await ctx.reply("Cat API is unreachable at the moment.")
@@ -525,10 +900,7 @@ def _get_user_timezone(user: Union[discord.User, discord.Member], default: Optio
 	- `user`: The user whose time zone we are seeking.
 	- `default` (default: UTC): The thing to return if no time zone is found for this user.
 	"""
-	tz = cursor.execute('SELECT timezone FROM users WHERE name=? LIMIT 1',(str(user),)).fetchall()
-	if len(tz) == 0:
-		return default
-	return _tz_fromstr(tz[0][0])
+	return _user_timezones.get(str(user), default)
 
 @bot.command(aliases=['get_timezone','get_time_zone'], brief='Retrieve someone\'s time zone.', help='Retrieves the currently stored time zone the specified `user`. If `user` is omitted, retrieves the time zone for the user who issued the command. If the user is not in the bot\'s database, UTC is the default time zone.')
 async def gettimezone(ctx, user = None):
@@ -553,12 +925,40 @@ async def settimezone(ctx, timezone, user = None):
 		target = ctx.author
 	tz = _tz_fromstr(timezone)
 	if tz:
-		cursor.execute('INSERT INTO users(name,timezone) VALUES(?,?) ON CONFLICT(name) DO UPDATE SET timezone=?',(str(target),rrulemap._tz_tostr(tz),rrulemap._tz_tostr(tz)))
-		db.commit()
+		await _write('INSERT INTO users(name,timezone) VALUES(?,?) ON CONFLICT(name) DO UPDATE SET timezone=?',(str(target),rrulemap._tz_tostr(tz),rrulemap._tz_tostr(tz)))
+		_user_timezones[str(target)] = tz
 		await ctx.reply(f'Time zone for {mention_or_str(target)} is now set to {rrulemap._tz_tostr(tz)}.')
 	else:
 		await ctx.reply(f'Unable to interpret {timezone} as a time zone. Please see {_timezone_url} for a list of canonical names for time zones.')
 
+def _parse_datetime(s: str) -> datetime.datetime:
+	"""
+	Interprets a `str` as a `datetime.datetime`, trying the builtin and then the strict ISO8601 parsers before the much slower general-purpose one.
+	
+	Parameters:
+	
+	- `s`: The string to interpret.
+	
+	Exceptions:
+	
+	- `dateutil.parser.ParserError` raised if `s` can't be interpreted as a datetime.
+	"""
+	if _iso_date_match(s):
+		try:
+			dt = datetime.datetime.fromisoformat(s)
+			if isinstance(dt.tzinfo, datetime.timezone):
+				# Keep handing back the same time zone types as `dateutil`, which the rest of the bot knows how to name.
+				off = dt.utcoffset()
+				dt = dt.replace(tzinfo = dateutil.tz.UTC if not off else dateutil.tz.tzoffset(None, off))
+			return dt
+		except ValueError:
+			pass
+		try:
+			return dateutil.parser.isoparse(s)
+		except ValueError:
+			pass
+	return dateutil.parser.parse(s)
+
 def _schedule_argparse(authortz: Optional[datetime.tzinfo], *args: list[str]) -> tuple[datetime.tzinfo, datetime.datetime, datetime.datetime]:
 	"""
 	Parses arguments for the `schedule` command.
@@ -574,7 +974,7 @@ def _schedule_argparse(authortz: Optional[datetime.tzinfo], *args: list[str]) ->
 			radius = durationparse.parse_duration(a)
 		elif not datetime2:
 			try:
-				tmp = dateutil.parser.parse(a)
+				tmp = _parse_datetime(a)
 				if not datetime1:
 					datetime1 = tmp
 				else:
@@ -603,19 +1003,18 @@ def _schedule_argparse(authortz: Optional[datetime.tzinfo], *args: list[str]) ->
 async def schedule(ctx, *args):
 	timezone, starttime, endtime = _schedule_argparse(_get_user_timezone(ctx.author), *args)
 	today = datetime.datetime.now(timezone)
+	showtype = _showtypes.get
+	show_list = [ [ a.astimezone(timezone), showtype(b.upper(), b) ] for a, b in _schedule.between(starttime, endtime) ]
+	next_show = None
 	if starttime <= today <= endtime:
-		show_list = sorted(map(lambda x: [ x[0].astimezone(timezone), _showtypes.get(x[1].upper(), x[1]) ], _schedule.between(starttime, endtime) + [[today, 'Now']]))
-		future = list(filter(lambda x: x > today, map(lambda x: x[0], show_list)))
-		next_show = min(future) if len(future) > 0 else None
-	else:
-		show_list = sorted(map(lambda x: [ x[0].astimezone(timezone), _showtypes.get(x[1].upper(), x[1]) ], _schedule.between(starttime, endtime)))
-		next_show = None
+		next_show = min((a for a, _ in show_list if a > today), default=None)
+		show_list.append([today, 'Now'])
+	show_list.sort()
 	await ctx.reply(embed = discord.Embed(title = f'AVPSO Schedule (TZ: {rrulemap._tz_tostr(timezone)})', description = '\n'.join([ f'{"**" if a == today else ""}{a.strftime(_timestamp_unzoned)}: {b}{"**" if a == today else ""}' for a, b in show_list ]) + ('' if next_show == None else f'\n\n{round_to_second(next_show-today)} remaining until the next show.')))
 
 @bot.command(hidden=True, brief="Display the Goosecifix.", description="Display the Goosecifix.")
 async def goosecifix(ctx):
-	cursor.execute("SELECT latin FROM honcs ORDER BY RANDOM() LIMIT 1")
-	embed = discord.Embed(title = cursor.fetchone()[0])
+	embed = discord.Embed(title = (await _random_rows("honcs", "latin"))[0][0])
 	embed.set_image(url=_goosecifix_url)
 	await ctx.reply(embed=embed)
 
@@ -623,10 +1022,26 @@ async def goosecifix(ctx):
 @commands.is_owner()
 async def addhonc(ctx, author, latin, english):
 	user = to_user(author)
-	cursor.execute("INSERT INTO honcs VALUES(?,?,?)", (latin, english, str(user)))
-	db.commit()
+	await _write("INSERT INTO honcs VALUES(?,?,?)", (latin, english, str(user)))
 	await ctx.reply("Done.")
 
+def _rangeify_core(q: list[int]) -> tuple[list[int], list[int]]:
+	"""
+	Finds the runs of consecutive integers in a sorted list, returning the first and last number of each run.
+	
+	Parameters:
+	
+	- `q`: The sorted numbers.
+	"""
+	if len(q) == 0:
+		return ([], [])
+	if numpy != None and len(q) >= _numpy_rangeify_min:
+		arr = numpy.asarray(q, dtype = numpy.int64)
+		breaks = numpy.flatnonzero(numpy.diff(arr) != 1) + 1
+		return (numpy.concatenate((arr[:1], arr[breaks])).tolist(), numpy.concatenate((arr[breaks-1], arr[-1:])).tolist())
+	breaks = [ i for i, a, b in zip(itertools.count(1), q, itertools.islice(q, 1, None)) if b != a + 1 ]
+	return ([ q[0] ] + [ q[i] for i in breaks ], [ q[i-1] for i in breaks ] + [ q[-1] ])
+
 def _rangeify(nums: Iterable[int]) -> list[str]:
 	"""
 	Collects consecutive integers into ranges and translates everything into strings.
@@ -635,35 +1050,17 @@ def _rangeify(nums: Iterable[int]) -> list[str]:
 	
 	- `nums`: The numbers we want to express as a list of ranges.
 	"""
-	q = sorted(nums)
-	r = []
-	i = 0
-	while i < len(q):
-		a = q[i]
-		b = q[i]
-		i += 1
-		while i < len(q) and q[i] == b + 1:
-			b = q[i]
-			i += 1
-		if a == b:
-			r.append(f"{a}")
-		else:
-			r.append(f"{a}-{b}")
-	return r
+	return [ f"{a}" if a == b else f"{a}-{b}" for a, b in zip(*_rangeify_core(sorted(nums))) ]
 
 @bot.command(aliases=['get_quote_numbers'], brief="Lists all quote numbers by the given user.", description="Lists the quote numbers for every quote in the database by the specified user. If no user is specified, lists all users quoted in the database together with the number of quotes by that user.")
 async def getquotenumbers(ctx, user=None):
 	if user == None:
-		cursor.execute("SELECT user, COUNT(ROWID) as numquotes FROM quotes GROUP BY user ORDER BY numquotes DESC, user ASC")
-		lines = []
-		for a, b in cursor.fetchall():
-			c = find_user(a)
-			lines.append(f"{b} quote{' is' if b == 1 else 's are'} attributed to {a if c == None else c.display_name}")
+		rows = await db.execute_fetchall("SELECT user, COUNT(*) as numquotes FROM quotes GROUP BY user ORDER BY numquotes DESC, user ASC")
+		lines = [ f"{b} quote{' is' if b == 1 else 's are'} attributed to {a if c == None else c.display_name}" for (a, b), c in zip(rows, find_users(a for a, _ in rows)) ]
 		await ctx.reply(embed = discord.Embed(title = "Quote Counts", description = "\n".join(lines)))
 	else:
 		author = to_user(user)
-		cursor.execute("SELECT ROWID FROM quotes WHERE user=?", (str(author),))
-		nums = list(itertools.chain.from_iterable(cursor.fetchall()))
+		nums = list(itertools.chain.from_iterable(await db.execute_fetchall("SELECT ROWID FROM quotes WHERE user=?", (str(author),))))
 		if len(nums) == 0:
 			await ctx.reply(f"There are no quotes in the database by {mention_or_str(author)}.")
 		else:
@@ -673,7 +1070,7 @@ async def getquotenumbers(ctx, user=None):
 @commands.check_any(commands.is_owner(), _is_guild_owner(), commands.has_role('The Pantheon'))
 async def addschedule(ctx, when, *, title):
 	try:
-		qq = dateutil.parser.parse(when)
+		qq = _parse_datetime(when)
 		if not qq.tzinfo:
 			qq = qq.replace(tzinfo = _get_user_timezone(ctx.author))
 	except dateutil.parser.ParserError:
@@ -685,15 +1082,14 @@ async def addschedule(ctx, when, *, title):
 			await ctx.reply(f'Can\'t interpret {when} as either a datetime or a recurrence rule.')
 			return
 	_schedule.add(qq, title)
-	_params['Schedule'] = pickle.dumps(_schedule).hex()
-	_save_config()
+	_mark_dirty(schedule = True)
 	await ctx.reply(f'Added {title} on schedule {when}.')
 
 @bot.command(aliases=['remove_schedule'], brief='Remove an entry or rule from the schedule (restricted).', description='Removes a new entry in the schedule. `when` should be either something which can be interpreted as a `datetime` using `dateutil.parser.parse` ( https://dateutil.readthedocs.io/en/stable/parser.html ) or something which can be interpreted as a recurrence rule using `dateutil.rrule.rrulestr` ( https://dateutil.readthedocs.io/en/stable/rrule.html\n`\n` will be replaced with a newline character before interpretation). (Only available to authorized users.)')
 @commands.check_any(commands.is_owner(), _is_guild_owner(), commands.has_role('The Pantheon'))
 async def removeschedule(ctx, when):
 	try:
-		qq = dateutil.parser.parse(when)
+		qq = _parse_datetime(when)
 		if not qq.tzinfo:
 			qq = qq.replace(tzinfo = _get_user_timezone(ctx.author))
 	except dateutil.parser.ParserError:
@@ -705,21 +1101,18 @@ async def removeschedule(ctx, when):
 			await ctx.reply(f'Can\'t interpret {when} as either a datetime or a recurrence rule.')
 			return
 	_schedule.remove(qq)
-	_params['Schedule'] = pickle.dumps(_schedule).hex()
-	_save_config()
+	_mark_dirty(schedule = True)
 	await ctx.reply(f'Removed {when} from the schedule.')
 
 @bot.command(aliases=['get_smell'], brief="Pick a smell at random.", description="Selects one smell from the list at random.")
 async def getsmell(ctx):
-	cursor.execute("SELECT * FROM smells ORDER BY RANDOM() LIMIT 1")
-	a = cursor.fetchone()
+	a = (await _random_rows("smells", "name"))[0]
 	await ctx.reply(a[0])
 
 @bot.command(aliases=['add_smell'], brief="Adds a smell to the list.", description="Adds a new smell to the list, if it is not already present.")
 async def addsmell(ctx, *, newsmell):
 	try:
-		cursor.execute("INSERT INTO smells VALUES(?)",(newsmell,))
-		db.commit()
+		await _write("INSERT INTO smells VALUES(?)",(newsmell,))
 		await ctx.reply("Added new smell to the list.")
 	except sqlite3.IntegrityError:
 		await ctx.reply("Failed to add new smell; it is already in the list.")
@@ -727,11 +1120,9 @@ async def addsmell(ctx, *, newsmell):
 @bot.command(brief="Pick a random perversion.", description="Picks a random sexual fetish, kink, or paraphilia from a fixed list.\nNote: This list does not distinguish between fetishes, kinks, and paraphilias; they are each called 'perversions'.\nThis list has been gathered from the Wikipedia page on paraphilias and the following link: https://badgirlsbible.com/list-of-kinks-and-fetishes")
 async def perversion(ctx, *term):
 	if term is None or len(term) == 0:
-		cursor.execute("SELECT name, description FROM perversions ORDER BY RANDOM() LIMIT 1")
-		a = cursor.fetchall()
+		a = await _random_rows("perversions", "name, description")
 	else:
-		cursor.execute("SELECT name, description FROM perversions WHERE LOWER(name)=?",(" ".join(term).lower(),))
-		a = cursor.fetchall()
+		a = await db.execute_fetchall("SELECT name, description FROM perversions WHERE name=? COLLATE NOCASE",(" ".join(term).lower(),))
 	if len(a) == 0:
 		await ctx.reply("Can't find a term by that name.")
 	else:
@@ -747,7 +1138,7 @@ async def botsource(ctx):
 
 @bot.command(brief = 'Show a random nonexistant metal album.', description = 'Randomly chooses one of the AI-generated metal albums (including band name, album title, and album cover art) from Twitter account @ai_metal_bot.')
 async def metal(ctx):
-	a = cursor.execute('SELECT tweetid, band, album FROM albums ORDER BY RANDOM() LIMIT 1').fetchone()
+	a = (await _random_rows("albums", "tweetid, band, album"))[0]
 	file = discord.File(os.path.join(_album_folder, f'{a[0]}.png'), filename = 'albumcover.png')
 	embed = discord.Embed(title = a[2], description = f'Band: {a[1]}')
 	embed.set_image(url = 'attachment://albumcover.png')
@@ -757,7 +1148,7 @@ async def metal(ctx):
 @commands.is_owner()
 async def addabbr(ctx, abbr, *, term):
 	_showtypes[abbr.upper()] = term
-	_save_config()
+	_mark_dirty()
 	await ctx.reply(f'Added {abbr.upper()} as an abbreviated show type for "{term}"')
 
 @bot.command(hidden = True, aliases = [ 'get_abbr' ], brief = 'Show current abbreviated show types.', description = 'Show current abbreviated show types. If you specify an abbreviation, only shows that (if it exists).')
@@ -775,6 +1166,7 @@ async def getabbr(ctx, abbr = None):
 async def delabbr(ctx, abbr):
 	if abbr.upper() in _showtypes:
 		del _showtypes[abbr.upper()]
+		_mark_dirty()
 		await ctx.reply(f'Deleted {abbr.upper()}.')
 	else:
 		await ctx.reply(f'{abbr.upper()} is not currently an abbreviation.')
@@ -791,17 +1183,17 @@ async def setrpgstatus(ctx, rpg, *, status):
 	elif rpg in _rpg_status:
 		if status == 'DELETE':
 			del _rpg_status[rpg]
-			_save_config()
+			_mark_dirty()
 			await ctx.reply(f'Deleted {rpg} from the list.')
 		else:
 			_rpg_status[rpg] = status
-			_save_config()
+			_mark_dirty()
 			await ctx.reply(f'Changed the status of {rpg} to {status}')
 	elif status == 'DELETE':
 		await ctx.reply(f'There is no RPG named {rpg}, so it cannot be deleted.')
 	else:
 		_rpg_status[rpg] = status
-		_save_config()
+		_mark_dirty()
 		await ctx.reply(f'Added {rpg} with status {status}')
 
 @bot.command(hidden = True, aliases = [ 'op_help', 'modhelp', 'mod_help' ], description = 'List all hidden commands.', brief = 'List all hidden commands.')
@@ -817,13 +1209,15 @@ async def quotesearch(ctx, *args):
 		terms = [ x.lower() for x in args ]
 		if '--all' in terms:
 			terms.remove('--all')
-			nums = list(itertools.chain.from_iterable(cursor.execute(f'SELECT ROWID FROM quotes WHERE {" AND ".join([ "LOWER(message) LIKE ?" ] * len(terms))}', list(map(lambda x: f'%{x}%', terms))).fetchall()))
+			where, params = _quote_search(terms)
+			nums = list(itertools.chain.from_iterable(await db.execute_fetchall(f'SELECT ROWID FROM quotes WHERE {where}', params)))
 			if len(nums) == 0:
 				await ctx.reply('There are no quotes matching those search terms.')
 			else:
 				await ctx.reply(embed = discord.Embed(title = f'{len(nums)} Quote{"" if len(nums) == 1 else "s"} Matching Search Terms', description = ', '.join(_rangeify(nums))))
 		else:
-			q = cursor.execute(f'SELECT ROWID, user, message, date_added FROM quotes WHERE {" AND ".join([ "LOWER(message) LIKE ?" ] * len(terms))} ORDER BY RANDOM() LIMIT 1', list(map(lambda x: f'%{x}%', terms))).fetchone()
+			where, params = _quote_search(terms)
+			q = await _fetchone(f'SELECT ROWID, user, message, date_added FROM quotes WHERE {where} ORDER BY RANDOM() LIMIT 1', params)
 			if q:
 				await ctx.reply(embed = format_quote(q))
 			else:
@@ -833,83 +1227,121 @@ async def quotesearch(ctx, *args):
 async def do_reactions(message):
 	if (message.guild != None and message.guild.name.lower() != _guildname) or message.author == bot.user:
 		return
-	txt = message.content.lower()
-	if re.search("b[l1][o0]bby", txt):
+	found = { m.lastgroup for m in _find_triggers(message.content.lower()) }
+	if len(found) == 0:
+		return
+	if 'blobby' in found:
 		await message.add_reaction(_reaction_patterns["Blobbyrape"])
-	if re.search("g[o0e3]{2}s[e3]", txt):
+	if 'honk' in found:
 		await message.add_reaction(_reaction_patterns["HONK"])
-	if re.search("br[a4]nd[o0]n", txt):
+	if 'brandon' in found:
 		now = datetime.datetime.now(dateutil.tz.UTC)
 		global _last_brandon
 		if now - _last_brandon > _brandon_frequency_cap:
 			_last_brandon = now
 			await message.channel.send(_brandon_url)
-	if re.search("c[o0]{2}k", txt):
+	if 'cook' in found:
 		await message.add_reaction(_reaction_patterns["Kay"])
-	if re.search("(?:\\W|^)[e3][a4]t", txt):
+	if 'eat' in found:
 		await message.add_reaction(_reaction_patterns["lee"])
-	if re.search('chicken', txt):
+	if 'chicken' in found:
 		await message.add_reaction(random.choice(_fruit_emoji))
-	if re.search('beef', txt):
+	if 'beef' in found:
 		await message.add_reaction(_reaction_patterns["spicybeef"])
-	if re.search('pain~[01](?:\\D|$)', txt):
+	if 'pain0' in found:
 		await message.add_reaction(_reaction_patterns['God'])
-	if re.search('pain~[23](?:\\D|$)', txt):
+	if 'pain2' in found:
 		await message.add_reaction(_reaction_patterns['Hesquatch'])
-	if re.search('pain~[45](?:\\D|$)', txt):
+	if 'pain4' in found:
 		await message.add_reaction(_reaction_patterns['Goveganmotherfuckers'])
-	if re.search('pain~[67](?:\\D|$)', txt):
+	if 'pain6' in found:
 		await message.add_reaction(_reaction_patterns['Tim_Noah'])
-	if re.search('pain~[89](?:\\D|$)', txt):
+	if 'pain8' in found:
 		await message.add_reaction(_reaction_patterns['Oogene'])
-	if re.search('pain~10(?:\\D|$)', txt):
+	if 'pain10' in found:
 		await message.add_reaction(_reaction_patterns['Blobbyrape'])
-	if re.search('interview', txt):
+	if 'interview' in found:
 		await message.add_reaction(_reaction_patterns['interviewplant'])
-	if re.search('том бомбадилло', txt):
+	if 'bombadil' in found:
 		await message.add_reaction(_reaction_patterns['Bombadil'])
 
 @bot.listen('on_raw_reaction_add')
 async def quote_by_reaction(payload):
-	user = bot.get_user(payload.user_id)
-	if user == bot.user:
+	if (payload.emoji.name or '')[:1] != _speech:
 		return
-	guild = bot.get_guild(payload.guild_id)
-	channel = bot.get_channel(payload.channel_id)
-	message = await channel.fetch_message(payload.message_id)
-	if guild.name.lower() != _guildname:
+	if payload.user_id == bot.user.id:
 		return
-	if str(payload.emoji)[0] == "\N{Left Speech Bubble}" and discord.utils.find(lambda x: str(x)[0]=="\N{Left Speech Bubble}", message.reactions).count == 1: # '\N{Left Speech Bubble}' == '\U0001f5e8'
+	guild = bot.get_guild(payload.guild_id) if payload.guild_id != None else None
+	if guild == None or guild.name.lower() != _guildname:
+		return
+	channel = bot.get_channel(payload.channel_id)
+	# The gateway updates a cached message's reactions before this listener runs, so only uncached messages need fetching.
+	message = discord.utils.get(bot.cached_messages, id=payload.message_id)
+	if message == None:
+		message = await channel.fetch_message(payload.message_id)
+	speech = next((r for r in message.reactions if isinstance(r.emoji, str) and r.emoji[:1] == _speech), None)
+	if speech != None and speech.count == 1:
 		if message.author == bot.user:
 			await channel.send(f"{bot.user.name} will not quote itself.")
 			return
-		a,b = insert_quote(message.author, message.clean_content)
+		a,b = await insert_quote(message.author, message.clean_content)
 		if a:
 			await channel.send(f"Successfully attributed quote #{b} to {message.author.mention}")
 		else:
 			await channel.send(f"Quote already exists in the database; it is #{b}.")
 
-def _fetch_metal() -> None:
+async def _download(url: str, filename: str, limit: asyncio.Semaphore) -> bool:
+	"""
+	Downloads `url` into `filename`. Returns whether or not the download succeeded.
+	
+	Parameters:
+	
+	- `url`: The URL to download.
+	- `filename`: The file to save it as.
+	- `limit`: Bounds how many downloads run at once.
+	"""
+	async with limit:
+		try:
+			async with _http_session.get(url, timeout = _download_timeout) as r:
+				r.raise_for_status()
+				data = await r.read()
+		except (aiohttp.ClientError, asyncio.TimeoutError):
+			return False
+	await asyncio.to_thread(_write_atomic, filename, data)
+	return True
+
+async def _fetch_metal() -> None:
 	"""
 	Looks up and downloads all of the new randomly generated metal albums from @ai_metal_bot on Twitter, storing them in the quote database.
 	"""
-	raw = subprocess.check_output(['snscrape', '--jsonl', 'twitter-user', 'ai_metal_bot'])
+	args = ['snscrape', '--jsonl', 'twitter-user', 'ai_metal_bot']
+	proc = await asyncio.create_subprocess_exec(*args, stdout = asyncio.subprocess.PIPE)
+	raw = (await proc.communicate())[0]
+	if proc.returncode != 0:
+		raise subprocess.CalledProcessError(proc.returncode, args)
 	new_tweets = list(map(json.loads, filter(lambda x: len(x)>0, raw.split(b'\n'))))
-	old_tweet_ids = list(itertools.chain(*cursor.execute('SELECT tweetid FROM albums').fetchall()))
-	count = 0
-	for tw in filter(lambda x: x['id'] not in old_tweet_ids, new_tweets):
+	# Covers already on disk don't need downloading again, but their albums still go through `INSERT OR IGNORE` in case an earlier check saved the cover without recording the album.
+	downloaded = frozenset(os.listdir(_album_folder))
+	found = []
+	for tw in new_tweets:
 		r = re.fullmatch('(?P<band>[\\w\\s]*) - (?P<album>[\\w\\s]*) https://t.co/\\w*', tw['content'])
 		if bool(r) and len(tw['media']) == 1:
-			with open(os.path.join(_album_folder, f'{tw["id"]}.png'), 'wb') as f:
-				f.write(urllib.request.urlopen(tw['media'][0]['fullUrl']).read())
-			cursor.execute('INSERT INTO albums VALUES(?,?,?)', (tw['id'], r['band'], r['album']))
-			count += 1
-	db.commit()
-	print(f'{_dt_tostr()} Checked for new tweets: {count} new, {len(old_tweet_ids)+count} total.')
+			found.append((tw, r))
+	missing = [ (tw, r) for tw, r in found if f'{tw["id"]}.png' not in downloaded ]
+	limit = asyncio.Semaphore(_max_downloads)
+	ok = await asyncio.gather(*[ _download(tw['media'][0]['fullUrl'], os.path.join(_album_folder, f'{tw["id"]}.png'), limit) for tw, r in missing ])
+	# Albums whose cover failed to download are left out, so they get another try on the next check.
+	failed = frozenset(tw['id'] for (tw, r), good in zip(missing, ok) if not good)
+	rows = [ (tw['id'], r['band'], r['album']) for tw, r in found if tw['id'] not in failed ]
+	count = 0
+	if len(rows) > 0:
+		async with _transaction():
+			count = (await db.executemany('INSERT OR IGNORE INTO albums VALUES(?,?,?)', rows)).rowcount
+	print(f'{_dt_tostr()} Checked for new tweets: {count} new, {(await _fetchone("SELECT COUNT(*) FROM albums"))[0]} total.')
 
 @tasks.loop(seconds=43200)
 async def update_metal():
-	_fetch_metal()
+	await _fetch_metal()
 
 @update_metal.before_loop
 async def before_update_metal():
@@ -917,12 +1349,23 @@ async def before_update_metal():
 
 @tasks.loop(seconds=_autosave_timer)
 async def store_config():
-	_save_config()
+	await _save_uptime()
+	await _flush_config()
 
 @store_config.before_loop
 async def before_store_config():
 	await bot.wait_until_ready()
 
+@tasks.loop(minutes=15)
+async def checkpoint_db():
+	await _write('PRAGMA wal_checkpoint(TRUNCATE)')
+	await _write('PRAGMA optimize')
+
+@checkpoint_db.before_loop
+async def before_checkpoint_db():
+	await bot.wait_until_ready()
+
 update_metal.start()
 store_config.start()
+checkpoint_db.start()
 bot.run(_token)
\ No newline at end of file
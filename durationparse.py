@@ -14,9 +14,12 @@ __docformat__ = 'restructuredtext'
 
 import dateutil.relativedelta
 import re
+import functools
+from typing import Optional
 
 duration_pattern = re.compile(r'^(?P<sign>[+-])?P(?!$)(?P<years>\d+Y)?(?P<months>\d+M)?(?P<weeks>\d+W)?(?P<days>\d+D)?(T(?!$)(?P<hours>\d+H)?(?P<minutes>\d+M)?(?P<seconds>\d+S)?)?$')
 
+@functools.lru_cache(maxsize=1024)
 def is_duration_string(target: str) -> bool:
 	"""
 	Determine whether or not the supplied string can be parsed as a duration string.
@@ -25,11 +28,22 @@ def is_duration_string(target: str) -> bool:
 	
 	- `target`: A string which may or may not be parsable as a duration
 	"""
-	return duration_pattern.fullmatch(target)
+	return duration_pattern.fullmatch(target) != None
 
+def _count(component: Optional[str]) -> int:
+	"""
+	Reads the number out of a single matched duration component such as `'12D'`. Components which weren't present count as zero.
+	
+	Parameters:
+	
+	- `component`: The matched component, or `None`.
+	"""
+	return int(component[:-1]) if component else 0
+
+@functools.lru_cache(maxsize=1024)
 def parse_duration(target: str) -> dateutil.relativedelta.relativedelta:
 	"""
-	Translate the given string into a duration.
+	Translate the given string into a duration. Results are cached, so the returned `relativedelta` must not be modified in place.
 	
 	Parameters:
 	
@@ -42,11 +56,8 @@ def parse_duration(target: str) -> dateutil.relativedelta.relativedelta:
 	m = duration_pattern.fullmatch(target)
 	if not m:
 		raise ValueError(f'String is not formatted as an ISO8601 duration: {target}')
-	groups = m.groupdict('00')
-	sgn = groups.pop('sign')
-	for k in groups:
-		groups[k] = int(groups[k][:-1])
-	q = dateutil.relativedelta.relativedelta(**groups)
+	sgn, y, mo, w, d, h, mi, s = m.group('sign', 'years', 'months', 'weeks', 'days', 'hours', 'minutes', 'seconds')
+	q = dateutil.relativedelta.relativedelta(years = _count(y), months = _count(mo), weeks = _count(w), days = _count(d), hours = _count(h), minutes = _count(mi), seconds = _count(s))
 	if sgn == '-':
 		q = -q
 	return q
@@ -17,11 +17,17 @@ import dateutil.relativedelta
 import dateutil.utils
 import datetime
 import itertools
+import heapq
 import copy
+import json
+import weakref
 from typing import Optional, Union, Any, TypeVar, Generic
+from collections.abc import Iterable, Iterator
 
 _compact_timestamp = "%Y%m%dT%H%M%S" # The specific datetime format used in the string format of recurrence rules.
 _maxdelta = dateutil.relativedelta.relativedelta(years=100) # Only considers datetimes between `now - _maxdelta` and `now + _maxdelta` unless otherwise specified.
+_tz_prefixes = tuple(dateutil.tz.TZFILES + dateutil.tz.TZPATHS) # Stripped from time zone file names to get the canonical name.
+_rrule_str_cache = weakref.WeakKeyDictionary() # `rrule`s are never modified in place, so each one only needs to be stringified once.
 
 KeyType = Union[datetime.datetime, dateutil.rrule.rrule]
 ValueType = TypeVar('V')
@@ -38,7 +44,7 @@ def _tz_tostr(t: Union[dateutil.tz.tzfile, dateutil.tz.tzutc, None] = None) -> O
 	if t == dateutil.tz.UTC or t == None:
 		return 'UTC'
 	tzn = t._filename
-	for prf in dateutil.tz.TZFILES + dateutil.tz.TZPATHS:
+	for prf in _tz_prefixes:
 		tzn = tzn.removeprefix(prf)
 	return tzn.lstrip('/')
 
@@ -51,33 +57,79 @@ def _rrule_tostr(r: dateutil.rrule.rrule, tabs: int = 0) -> str:
 	- `r`: The `rrule` to be represented as a string.
 	- `tabs` (default: 0): All lines after the first will begin with `tabs` tab characters.
 	"""
-	tabstr = '\n'+'\t'*tabs
-	if r._tzinfo:
-		ans = str(r).replace('DTSTART:',f'DTSTART;TZID={_tz_tostr(r._tzinfo)}:')
-		if r._until:
-			ans = ans.replace(f'UNTIL={r._until.strftime(_compact_timestamp)}',f'UNTIL={r._until.astimezone(dateutil.tz.UTC).strftime(_compact_timestamp)}Z')
-		if tabs:
-			ans = ans.replace('\n',tabstr)
-		return ans
-	return str(r).replace('\n',tabstr)
+	ans = _rrule_str_cache.get(r)
+	if ans == None:
+		ans = str(r)
+		if r._tzinfo:
+			ans = ans.replace('DTSTART:',f'DTSTART;TZID={_tz_tostr(r._tzinfo)}:')
+			if r._until:
+				ans = ans.replace(f'UNTIL={r._until.strftime(_compact_timestamp)}',f'UNTIL={r._until.astimezone(dateutil.tz.UTC).strftime(_compact_timestamp)}Z')
+		_rrule_str_cache[r] = ans
+	if tabs:
+		return ans.replace('\n','\n'+'\t'*tabs)
+	return ans
+
+def _dt_tojson(dt: datetime.datetime) -> dict[str, Optional[str]]:
+	"""
+	Represents a `datetime.datetime` as a JSON-compatible `dict`. Named time zones are kept by name so that daylight saving time still applies once loaded; any other time zone is kept as a fixed UTC offset.
+	
+	Parameters:
+	
+	- `dt`: The `datetime.datetime` to represent.
+	"""
+	if dt.tzinfo == dateutil.tz.UTC or isinstance(dt.tzinfo, dateutil.tz.tzfile):
+		return { 'datetime': dt.replace(tzinfo = None).isoformat(), 'tz': _tz_tostr(dt.tzinfo) }
+	return { 'datetime': dt.isoformat(), 'tz': None }
+
+def _dt_fromjson(d: dict[str, Optional[str]]) -> datetime.datetime:
+	"""
+	Inverse of `_dt_tojson`.
+	
+	Parameters:
+	
+	- `d`: Something that was (or could have been) obtained through `_dt_tojson`.
+	"""
+	dt = datetime.datetime.fromisoformat(d['datetime'])
+	if d['tz'] == None:
+		# `fromisoformat` gives back a `datetime.timezone`; use the equivalent `dateutil` time zone that was saved.
+		off = dt.utcoffset()
+		if off == None:
+			return dt
+		return dt.replace(tzinfo = dateutil.tz.UTC if not off else dateutil.tz.tzoffset(None, off))
+	return dt.replace(tzinfo = dateutil.tz.UTC if d['tz'] == 'UTC' else dateutil.tz.gettz(d['tz']))
 
 class RRuleMap(Generic[ValueType]):
 	"""
 	A map of `datetime.datetime` (keys) to anything (values), where the keys can be specified using `dateutil.rrule.rrule`s as well as `datetime.datetime`s. Optional timestamp format (including time zone) can also be stored as part of this class.
 	"""
 	
-	def __init__(self, rules: list[ItemType] = [], timestamp: Optional[str] = None) -> None:
+	def __init__(self, rules: Optional[list[ItemType]] = None, timestamp: Optional[str] = None) -> None:
 		"""
 		Initialize an instance of `RRuleMap`.
 		
 		Parameters:
 		
-		- `rules` (default: []): An initial list of rules.
+		- `rules` (default: []): An initial list of rules. The list is copied, so later changes to it don't affect this map.
 		- `timestamp` (default: "[%Y-%m-%d %H:%M:%S {tz}]"): A string which can be used with `datetime.datetime.strftime` followed by `.format(tz=timezone_name)`.
 		"""
-		self._rulelist = copy.deepcopy(rules)
+		self._rulelist = [] if rules == None else copy.deepcopy(rules)
 		self._timestamp = "[%Y-%m-%d %H:%M:%S {tz}]" if timestamp == None else timestamp
 	
+	@classmethod
+	def _from_state(cls, rulelist: list[ItemType], timestamp: str) -> 'RRuleMap':
+		"""
+		Creates an `RRuleMap` which takes ownership of `rulelist` as it is, without copying it.
+		
+		Parameters:
+		
+		- `rulelist`: The list of rules.
+		- `timestamp`: The timestamp format.
+		"""
+		ans = cls.__new__(cls)
+		ans._rulelist = rulelist
+		ans._timestamp = timestamp
+		return ans
+	
 	def _datetime_tostr(self, dt: datetime.datetime) -> None:
 		"""
 		Represents a `datetime.datetime` as a `str` using the timestamp for this `RRuleMap`, together with canonical time zone.
@@ -123,30 +175,43 @@ class RRuleMap(Generic[ValueType]):
 		- `dtstart`: The lowerbound datetime.
 		- `dtend`: The upperbound datetime.
 		"""
-		ans = {}
-		for a, b in self._rulelist:
+		return [ [a, b] for a, b in self._merged(dtstart, dtend) if b ]
+	
+	def _merged(self, dtstart: datetime.datetime, dtend: datetime.datetime) -> Iterator[tuple[datetime.datetime, Optional[ValueType]]]:
+		"""
+		Lazily yields every datetime raised by any rule between `dtstart` and `dtend` (inclusive) in chronological order, together with the value of the last rule raising it (which may be `None`).
+		
+		Parameters:
+		
+		- `dtstart`: The lowerbound datetime.
+		- `dtend`: The upperbound datetime.
+		"""
+		def occurrences(i: int, a: KeyType, b: Optional[ValueType]) -> Iterable[tuple[datetime.datetime, int, Optional[ValueType]]]:
 			if isinstance(a, datetime.datetime):
-				if dtstart <= a <= dtend:
-					ans[a] = b
-			else:
-				ans.update(zip(a.between(dtstart, dtend, inc = True), itertools.repeat(b)))
-		return sorted(filter(lambda x: bool(x[1]), map(list, ans.items())), key=lambda x: x[0])
+				return [ (a, i, b) ] if dtstart <= a <= dtend else []
+			return ( (x, i, b) for x in itertools.takewhile(lambda x: x <= dtend, a.xafter(dtstart, inc = True)) )
+		# Each rule's occurrences are already sorted, so a merge keyed on (datetime, position in the list) puts every datetime's rules next to each other, with the one that takes precedence last.
+		for _, group in itertools.groupby(heapq.merge(*[ occurrences(i, a, b) for i, (a, b) in enumerate(self._rulelist) ]), key = lambda x: x[0]):
+			first = last = next(group)
+			for last in group:
+				pass
+			yield first[0], last[2]
 	
 	def __copy__(self) -> 'RRuleMap':
 		"""
-		Makes a copy of this `RRuleMap`. This method is supposed to return a shallow copy, but it returns a deep copy anyway.
+		Makes a shallow copy of this `RRuleMap`. The keys and values are shared with this map, but each rule's entry is copied since `cull_covered` modifies entries in place.
 		"""
-		return RRuleMap(self._rulelist, self._timestamp)
+		return self._from_state([ [a, b] for a, b in self._rulelist ], self._timestamp)
 	
-	def __deepcopy__(self, memo: dict = {}) -> 'RRuleMap':
+	def __deepcopy__(self, memo: Optional[dict] = None) -> 'RRuleMap':
 		"""
 		Makes a deep copy of this `RRuleMap`.
 		
 		Parameters:
 		
-		- `memo`: A memo dictionary.
+		- `memo` (default: None): A memo dictionary.
 		"""
-		return RRuleMap(self._rulelist, self._timestamp)
+		return self._from_state(copy.deepcopy(self._rulelist, memo), self._timestamp)
 	
 	def __getstate__(self) -> tuple[str, list[tuple[Union[datetime.datetime, str], Optional[ValueType]]]]:
 		"""
@@ -165,6 +230,27 @@ class RRuleMap(Generic[ValueType]):
 		self._timestamp = state[0]
 		self._rulelist = [ [a if isinstance(a, datetime.datetime) else dateutil.rrule.rrulestr(a), b] for a, b in state[1] ]
 	
+	def to_json(self) -> str:
+		"""
+		Serializes this `RRuleMap` as JSON. Unlike a pickle, the result can be loaded without running arbitrary code. Values must themselves be JSON-serializable.
+		"""
+		state = self.__getstate__()
+		return json.dumps([ state[0], [ [_dt_tojson(a) if isinstance(a, datetime.datetime) else a, b] for a, b in state[1] ] ])
+	
+	@classmethod
+	def from_json(cls, s: str) -> 'RRuleMap':
+		"""
+		Creates an `RRuleMap` from JSON produced by `RRuleMap.to_json`.
+		
+		Parameters:
+		
+		- `s`: The JSON to load.
+		"""
+		state = json.loads(s)
+		ans = cls.__new__(cls)
+		ans.__setstate__([ state[0], [ [_dt_fromjson(a) if isinstance(a, dict) else a, b] for a, b in state[1] ] ])
+		return ans
+	
 	def __getitem__(self, key: datetime.datetime) -> Optional[ValueType]:
 		"""
 		Retrieve the value associated with the given key. Returns `None` if the key is not present.
@@ -173,7 +259,7 @@ class RRuleMap(Generic[ValueType]):
 		
 		- `key`: The particular datetime being sought.
 		"""
-		for a, b in self._rulelist[::-1]:
+		for a, b in reversed(self._rulelist):
 			if RRuleMap._hasdate(a, key):
 				return b
 		return None
@@ -184,46 +270,6 @@ class RRuleMap(Generic[ValueType]):
 		"""
 		return '\n'.join([ f'{"Remove" if b == None else str(b)}: {self._datetime_tostr(a) if isinstance(a, datetime.datetime) else _rrule_tostr(a,1)}' for a, b in self._rulelist ])
 	
-	@staticmethod
-	def _uncovered(target: KeyType, overlist: list[ItemType], dtrange: Union[datetime.datetime, list[datetime.datetime], None] = None) -> set[datetime.datetime]:
-		"""
-		Figure out which datetimes in `target` are not overridden by something in `overlist`.
-		
-		Parameters:
-		
-		- `target`: The individual key - we are trying to determine whether or not it is still relevant.
-		- `overlist`: The list of items which may or may not fully or partially cover the target.
-		- `dtrange` (default: `None`): Restricts the range of datetimes to consider, so that we don't have to deal with recursive reasoning or go into an infinite loop.
-		
-			If this is `None`, uses the range of `now - _maxdelta` to `now + _maxdelta`. If this is a single `datetime.datetime`, uses the range of `dtrange - _maxdelta` to `dtrange + _maxdelta`. If this is a pair of `datetime.datetime`s uses them as the start and end of the range. If given more than two, ignores everything past the first two.
-		
-		Exceptions:
-		
-		- `TypeError` raised if `dtrange` is not of an appropriate type.
-		"""
-		if dtrange == None:
-			midtime = datetime.datetime.now(dateutil.tz.UTC)
-			starttime, endtime = midtime - _maxdelta, midtime + _maxdelta
-		elif isinstance(dtrange, datetime.datetime):
-			starttime, endtime = dtrange - _maxdelta, dtrange + _maxdelta
-		elif len(dtrange) >= 2:
-			starttime, endtime = dtrange[:2]
-		else:
-			raise TypeError(f'{type(dtrange)} is not appropriate for argument `dtrange`.')
-		if isinstance(target, datetime.datetime):
-			if starttime <= target <= endtime:
-				base = { target }
-			else:
-				return set()
-		else:
-			base = set(target.between(starttime, endtime, inc = True))
-		for j in overlist:
-			if isinstance(j[0], datetime.datetime):
-				base.discard(j[0])
-			else:
-				base -= j[0].between(starttime, endtime, inc=True)
-		return base
-	
 	def cull_covered(self) -> None:
 		"""
 		Remove any items which are entirely covered.
@@ -231,15 +277,23 @@ class RRuleMap(Generic[ValueType]):
 		Any items contained in this mapping which cannot actually be relevant because every datetime they raise is also raised by a later rule are discarded from the list to boost efficiency.
 		"""
 		midtime = datetime.datetime.now(dateutil.tz.UTC)
-		to_remove = []
-		for i in range(len(self._rulelist)-1):
-			base = RRuleMap._uncovered(self._rulelist[i][0], self._rulelist[i+1:])
+		starttime, endtime = midtime - _maxdelta, midtime + _maxdelta
+		# Walk the list backwards, accumulating everything raised by later items, so that each item only has to be expanded once.
+		covered = set()
+		for i in range(len(self._rulelist)-1, -1, -1):
+			a = self._rulelist[i][0]
+			if isinstance(a, datetime.datetime):
+				raised = { a } if starttime <= a <= endtime else set()
+			else:
+				raised = set(a.between(starttime, endtime, inc = True))
+			base = raised - covered
+			covered |= raised
+			if i == len(self._rulelist)-1:
+				continue
 			if len(base) == 0:
-				to_remove.append(i)
-			elif not isinstance(self._rulelist[i][0], datetime.datetime) and len(base)==1:
+				del self._rulelist[i]
+			elif not isinstance(a, datetime.datetime) and len(base)==1:
 				self._rulelist[i][0] = base.pop()
-		for i in to_remove[::-1]:
-			del self._rulelist[i]
 		return self
 	
 	def add(self, key: KeyType, value: Optional[ValueType]) -> None:
@@ -288,17 +342,7 @@ class RRuleMap(Generic[ValueType]):
 		"""
 		if dtstart == None:
 			dtstart = datetime.datetime.now(dateutil.tz.UTC)
-		dtnext = dtstart + _maxdelta
-		for i in range(len(self._rulelist)):
-			if (entrytype != None and self._rulelist[i][1] != entrytype) or self._rulelist[i][1] == None:
-				continue
-			if isinstance(self._rulelist[i][0], datetime.datetime) and (dtstart <= self._rulelist[i][0] <= dtnext):
-				if RRuleMap._uncovered(self._rulelist[i][0], self._rulelist[i+1:], [dtstart, dtnext]):
-					dtnext = self._rulelist[i][0]
-			else:
-				base = RRuleMap._uncovered(self._rulelist[i][0], self._rulelist[i+1:], [dtstart, dtnext])
-				if base:
-					dtnext = min(base)
-		if self[dtnext]:
-			return dtnext
+		for a, b in self._merged(dtstart, dtstart + _maxdelta):
+			if b and (entrytype == None or b == entrytype):
+				return a
 		return None